@@ -1,12 +1,20 @@
 import numpy as np
-import pandas as pd
 import xarray as xr
 import rioxarray as rxr
 
+from tools.catalog import load_catalog, lookup_catalog, validate_catalog
+from tools.constants import ENSEMBLE_STATS
+from tools.helpers import ensemble_stats, save_netcdf
+from tools.profiling import RunReport
 
-# Read GAEZ dataframe, which contains mapping of path to tif files
+
+report = RunReport('step_01_merge_GAEZ_to_NC')
+
+
+# Read GAEZ catalog, which contains mapping of path to tif files
 #   by default, input_level = High
-GAEZ_df = pd.read_csv('data/GAEZ_v4/GAEZ_df.csv').query('input_level == "High"')
+GAEZ_catalog = load_catalog()
+validate_catalog(GAEZ_catalog, check_files=True)
 GAEZ_4_vars = ["year", "model", "rcp", "crop", "water_supply", "c02_fertilization"]
 
 
@@ -24,62 +32,77 @@ def get_xr_darray_from_df(in_df):
     arrs = [] 
     for idx,row in in_df.iterrows():
         dim_coord = {k:[v] for k,v in zip(in_df.index.names, idx)}
-        arrs.append(
-            rxr.open_rasterio(row['fpath'] + '_clipped.tif', masked=True)
-            .drop_vars('band')
-            .squeeze()
-            .expand_dims(dim_coord)
-        )
+        with report.unit('file', fpath=row['fpath']):
+            arrs.append(
+                rxr.open_rasterio(row['fpath'] + '_clipped.tif', masked=True)
+                .drop_vars('band')
+                .squeeze()
+                .expand_dims(dim_coord)
+                .load()
+            )
 
     out_xr = xr.combine_by_coords(arrs, combine_attrs='drop')
     return out_xr
 
-def calc_mean_std(in_xr):
-    mean_xr = in_xr.mean(dim='model').expand_dims(band=['mean'])
-    std_xr = in_xr.std(dim='model').expand_dims(band=['std'])
-    return xr.concat([mean_xr, std_xr], dim='band')
+# helper function to read the tif files one at a time, for streaming them through ensemble_stats
+def read_rasters(fpaths):
+    for fpath in fpaths:
+        with report.unit('file', fpath=fpath):
+            arr = rxr.open_rasterio(fpath + '_clipped.tif', masked=True).drop_vars('band').squeeze().load()
+        yield arr
 
 # Get historical yield
-#  set the standard deviation for historical yield is 0
+#  set the standard deviation for historical yield is 0, and min/max/median to the yield itself
 #  this make it compatible with future yield data structure
 GAEZ_4_hist = (
-    GAEZ_df.query('gaez_cat == "GAEZ_4" and name.str.contains("ycHa|ycHg") and rcp == "Historical"')
+    lookup_catalog(GAEZ_catalog, gaez_cat='GAEZ_4', rcp='Historical')
+    .query('name.str.contains("ycHa|ycHg") and input_level == "High"')
     .reset_index(drop=True)[[*GAEZ_4_vars, 'fpath']]
     .replace({'year': year_rename})
     .set_index(GAEZ_4_vars)
     .reset_index(['model', 'rcp', 'c02_fertilization'], drop=True)
 )
 
-GAEZ_4_hist_xr = get_xr_darray_from_df(GAEZ_4_hist)
+with report.unit('historical'):
+    GAEZ_4_hist_xr = get_xr_darray_from_df(GAEZ_4_hist)
+    report.add_array('GAEZ_4_hist_xr', GAEZ_4_hist_xr)
 GAEZ_4_hist_xr = xr.concat(
-    [GAEZ_4_hist_xr.expand_dims(band=['mean']),
-     (GAEZ_4_hist_xr * 0).expand_dims(band=['std'])],
+    [(GAEZ_4_hist_xr * 0 if stat == 'std' else GAEZ_4_hist_xr).expand_dims(band=[stat]) for stat in ENSEMBLE_STATS],
     dim='band'
 )
 
 
 # Get future yield
-#  Rice has missing rows:
+#  Rice has missing rows (reported by validate_catalog above):
 #   year=2071-2100, model=MIROC-ESM-CHEM, rcp=RCP4.5, crop=Wetland rice, water_supply=Irrigated, co2_fertilization=With CO2 Fertilization
 #   year=2071-2100, model=MIROC-ESM-CHEM, rcp=RCP4.5, crop=Wetland rice, water_supply=Irrigated, co2_fertilization=Without CO2 Fertilization
-
-GAEZ_4_future = (
-    GAEZ_df.query('gaez_cat == "GAEZ_4" and rcp != "Historical"')
-    .replace({'year': year_rename})
-    .reset_index(drop=True)[[*GAEZ_4_vars, 'fpath']]
-)
-GAEZ_4_future_wheat = GAEZ_4_future.query('crop == "Wheat"').set_index(GAEZ_4_vars)
-GAEZ_4_future_maize = GAEZ_4_future.query('crop == "Maize"').set_index(GAEZ_4_vars)
-GAEZ_4_future_rice = GAEZ_4_future.query('crop == "Wetland rice"').set_index(GAEZ_4_vars)
-
-GAEZ_4_future_wheat_xr = calc_mean_std(get_xr_darray_from_df(GAEZ_4_future_wheat))
-GAEZ_4_future_maize_xr = calc_mean_std(get_xr_darray_from_df(GAEZ_4_future_maize))
-GAEZ_4_future_rice_xr = calc_mean_std(get_xr_darray_from_df(GAEZ_4_future_rice))
-
-GAEZ_4_future_xr = xr.concat(
-    [GAEZ_4_future_wheat_xr, GAEZ_4_future_maize_xr, GAEZ_4_future_rice_xr],
-    dim='crop'
-)
+#  Each scenario is reduced across models by streaming its tif files, so only one raster
+#  (plus the running statistics) is in memory instead of all models of a crop
+GAEZ_4_future_rcps = [rcp for rcp in GAEZ_catalog.index.unique('rcp').dropna() if rcp != 'Historical']
+GAEZ_4_scenario_vars = [var for var in GAEZ_4_vars if var != 'model']
+
+GAEZ_4_future_xrs = []
+for crop in GAEZ_catalog.index.unique('crop').dropna():
+    GAEZ_4_future = (
+        lookup_catalog(GAEZ_catalog, gaez_cat='GAEZ_4', crop=crop, rcp=GAEZ_4_future_rcps)
+        .query('input_level == "High"')
+        .replace({'year': year_rename})[[*GAEZ_4_vars, 'fpath']]
+    )
+    if GAEZ_4_future.empty:
+        print(f"No GAEZ_4 future yield in the catalog for {crop}, skipped")
+        continue
+    with report.unit('future_crop', crop=crop):
+        scenario_xrs = []
+        for scenario, scenario_df in GAEZ_4_future.groupby(GAEZ_4_scenario_vars):
+            scenario_xrs.append(
+                ensemble_stats(read_rasters(scenario_df['fpath']))
+                .expand_dims({k:[v] for k,v in zip(GAEZ_4_scenario_vars, scenario)})
+            )
+        crop_xr = xr.combine_by_coords(scenario_xrs, combine_attrs='drop').transpose('band', *GAEZ_4_scenario_vars, ...)
+        report.add_array('crop_xr', crop_xr)
+        GAEZ_4_future_xrs.append(crop_xr)
+
+GAEZ_4_future_xr = xr.concat(GAEZ_4_future_xrs, dim='crop')
 
 
 # Convert (kg dry-weight)/ha to (t yield)/ha
@@ -94,5 +117,9 @@ GAEZ_4_hist_xr = GAEZ_4_hist_xr * convesion_factor
 GAEZ_4_future_xr = GAEZ_4_future_xr * convesion_factor
 
 # Save to netcdf
-GAEZ_4_hist_xr.to_netcdf('data/GAEZ_v4/GAEZ_4_historical_t_ha.nc')
-GAEZ_4_future_xr.to_netcdf('data/GAEZ_v4/GAEZ_4_future_t_ha.nc')
+with report.unit('save'):
+    save_netcdf(GAEZ_4_hist_xr, 'data/GAEZ_v4/GAEZ_4_historical_t_ha.nc')
+    save_netcdf(GAEZ_4_future_xr, 'data/GAEZ_v4/GAEZ_4_future_t_ha.nc')
+
+report.save()
+
@@ -1,44 +1,34 @@
-import numpy as np
 import xarray as xr
-import itertools
 
-# Read GAEZ_4 yield data
-#  Only need the mean band for getting multipliers
-GAEZ_4_hist_t_ha = xr.open_dataarray('data/GAEZ_v4/GAEZ_4_historical_t_ha.nc').compute()
-GAEZ_4_future_t_ha = xr.open_dataarray('data/GAEZ_v4/GAEZ_4_future_t_ha.nc').compute()
-
-GAEZ_4_t_ha = xr.concat([GAEZ_4_hist_t_ha, GAEZ_4_future_t_ha], dim='year')
+from tools.constants import MULTIPLIER_CAP_PERCENTILE, MULTIPLIER_CAP_MAX
+from tools.helpers import cap_multipliers, get_yield_multipliers, save_netcdf
+from tools.profiling import RunReport
 
-# Get GAEZ_4 for 2020
-GAEZ_4_yr_2020_t_ha = GAEZ_4_t_ha.interp(year=[2020], method='linear')
-GAEZ_4_yr_2020_t_ha = GAEZ_4_yr_2020_t_ha.drop_vars('year').squeeze().astype(np.float32)
 
-# Get the yield multipliers
-GAEZ_4_multiplier = (
-    GAEZ_4_future_t_ha / GAEZ_4_yr_2020_t_ha
-)
+report = RunReport('step_02_get_yield_multipliers')
 
+# Read GAEZ_4 yield data
+#  Only need the mean band for getting multipliers
+with report.unit('load'):
+    GAEZ_4_hist_t_ha = xr.open_dataarray('data/GAEZ_v4/GAEZ_4_historical_t_ha.nc').compute()
+    GAEZ_4_future_t_ha = xr.open_dataarray('data/GAEZ_v4/GAEZ_4_future_t_ha.nc').compute()
+    report.add_array('GAEZ_4_future_t_ha', GAEZ_4_future_t_ha)
 
-# --------- loop through each layer to exclude extreme multipliers ---------
-dims_to_iterate = ['year', 'rcp', 'crop', 'water_supply', 'c02_fertilization']
+# Get the yield multipliers, relative to GAEZ_4 for 2020
+GAEZ_4_multiplier = get_yield_multipliers(GAEZ_4_hist_t_ha, GAEZ_4_future_t_ha)
 
-dim_values = {
-    dim: GAEZ_4_multiplier.coords[dim].values.tolist()
-    for dim in dims_to_iterate
-}
 
-all_combinations = list(itertools.product(*[dim_values[dim] for dim in dims_to_iterate]))
+# --------- cap each layer to exclude extreme multipliers ---------
+with report.unit('cap'):
+    GAEZ_4_multiplier, extreme_max = cap_multipliers(GAEZ_4_multiplier, MULTIPLIER_CAP_PERCENTILE, MULTIPLIER_CAP_MAX)
+    report.add_array('GAEZ_4_multiplier', GAEZ_4_multiplier)
 
-# Iterate through all combinations
-for combo in all_combinations:
-    sel_dict = dict(zip(dims_to_iterate, combo))
-    spatial_band = GAEZ_4_multiplier.sel(sel_dict)
-    extreme_max = min(np.nanpercentile(spatial_band, 95), 2.0)
-    print(f"Processing {sel_dict}, setting max to {extreme_max:.4f}")
-    spatial_band = spatial_band.clip(max=extreme_max)
-    
-    GAEZ_4_multiplier.loc[sel_dict] = spatial_band
+for sel_dict, cap in extreme_max.to_dataframe('cap')['cap'].items():
+    print(f"Capped {dict(zip(extreme_max.dims, sel_dict))} at {cap:.4f}")
 
 
 # Save the yield multipliers
-GAEZ_4_multiplier.to_netcdf('data/GAEZ_v4/GAEZ_4_yield_multipliers.nc')
+with report.unit('save'):
+    save_netcdf(GAEZ_4_multiplier, 'data/GAEZ_v4/GAEZ_4_yield_multipliers.nc')
+
+report.save()
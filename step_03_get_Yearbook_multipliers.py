@@ -9,6 +9,12 @@ import statsmodels.api as sm
 from rasterio.features import rasterize
 
 from tools.constants import Province_names_cn_en
+from tools.catalog import get_sample_tif_path, load_catalog
+from tools.helpers import filter_scenarios_df, save_netcdf
+from tools.profiling import RunReport
+
+
+report = RunReport('step_03_get_Yearbook_multipliers')
 
 PRED_BASE_YR = 2020
 PRED_TARGET_YR = 2100
@@ -67,17 +73,21 @@ yearbook_yield = pd.concat([
     maize_yield_history], axis=0
 ).query('year >= 1990').reset_index(drop=True)
 
+# Only keep the selected crops
+yearbook_yield = filter_scenarios_df(yearbook_yield).reset_index(drop=True)
+
 yearbook_yield['Yield (tonnes)'] = yearbook_yield['Value'] / 1000
 yearbook_yield.to_csv('data/Yearbook/yearbook_crop_yield_hist.csv', index=False)
 
 
 # Function to fit a linear model to the data
 yearbook_yield_fitted = pd.DataFrame()
-for (province,crop), df in yearbook_yield.groupby(['Province', 'crop']):
-    fitted_df = fit_linear_model(df)
-    fitted_df.insert(0, 'Province', province)
-    fitted_df.insert(1, 'crop', crop)
-    yearbook_yield_fitted = pd.concat([yearbook_yield_fitted, fitted_df])
+with report.unit('fit', n_groups=yearbook_yield.groupby(['Province', 'crop']).ngroups):
+    for (province,crop), df in yearbook_yield.groupby(['Province', 'crop']):
+        fitted_df = fit_linear_model(df)
+        fitted_df.insert(0, 'Province', province)
+        fitted_df.insert(1, 'crop', crop)
+        yearbook_yield_fitted = pd.concat([yearbook_yield_fitted, fitted_df])
 
 yearbook_yield_fitted = yearbook_yield_fitted.sort_values(['Province','crop','year']).reset_index(drop=True)
 
@@ -126,7 +136,7 @@ yearbook_multipliers_df = yearbook_multipliers_df.pivot(
 
 
 # Rasterise multipliers to Province-level in China (mosaiced raster for all provinces)
-GAEZ_sample_xr = rxr.open_rasterio('data/GAEZ_v4/GAEZ_tifs/0a1a4943-3ec5-490e-8670-cc3ee7953729.tif_clipped.tif', masked=True).drop_vars('band').squeeze()
+GAEZ_sample_xr = rxr.open_rasterio(get_sample_tif_path(load_catalog()), masked=True).drop_vars('band').squeeze()
 China_shp = gpd.read_file('data/Vector_boundary/China_boundary.shp')
 
 # Get unique values for each dimension (excluding Province)
@@ -160,59 +170,64 @@ rasterized_multipliers = xr.DataArray(
 # Loop through each crop and year combination, rasterizing all provinces together
 for crop in crops:
     for year in years:
-        # Filter data for this crop and year (all provinces)
-        subset = yearbook_multipliers_df[
-            (yearbook_multipliers_df['crop'] == crop) &
-            (yearbook_multipliers_df['year'] == year)
-        ]
-
-        # Merge with shapefile to get geometries for all provinces
-        raster_shp = China_shp.merge(
-            subset,
-            left_on='EN_Name',
-            right_on='Province',
-            how='inner'
-        )
-
-        # Rasterize mean - burn all province geometries with their respective values
-        shapes_mean = [(geom, value) for geom, value in zip(raster_shp.geometry, raster_shp['mean'])]
-        rasterized_mean = rasterize(
-            shapes_mean,
-            out_shape=GAEZ_sample_xr.shape,
-            transform=GAEZ_sample_xr.rio.transform(),
-            fill=np.nan,
-            dtype='float32'
-        )
-
-        # Rasterize std - burn all province geometries with their respective values
-        shapes_std = [(geom, value) for geom, value in zip(raster_shp.geometry, raster_shp['std'])]
-        rasterized_std = rasterize(
-            shapes_std,
-            out_shape=GAEZ_sample_xr.shape,
-            transform=GAEZ_sample_xr.rio.transform(),
-            fill=np.nan,
-            dtype='float32'
-        )
+        with report.unit('rasterize', crop=crop, year=year):
+            # Filter data for this crop and year (all provinces)
+            subset = yearbook_multipliers_df[
+                (yearbook_multipliers_df['crop'] == crop) &
+                (yearbook_multipliers_df['year'] == year)
+            ]
+
+            # Merge with shapefile to get geometries for all provinces
+            raster_shp = China_shp.merge(
+                subset,
+                left_on='EN_Name',
+                right_on='Province',
+                how='inner'
+            )
 
-        # Assign to the DataArray
-        rasterized_multipliers.loc[
-            dict(
-                crop=crop,
-                year=year,
-                band='mean'
+            # Rasterize mean - burn all province geometries with their respective values
+            shapes_mean = [(geom, value) for geom, value in zip(raster_shp.geometry, raster_shp['mean'])]
+            rasterized_mean = rasterize(
+                shapes_mean,
+                out_shape=GAEZ_sample_xr.shape,
+                transform=GAEZ_sample_xr.rio.transform(),
+                fill=np.nan,
+                dtype='float32'
             )
-        ] = rasterized_mean
 
-        rasterized_multipliers.loc[
-            dict(
-                crop=crop,
-                year=year,
-                band='std'
+            # Rasterize std - burn all province geometries with their respective values
+            shapes_std = [(geom, value) for geom, value in zip(raster_shp.geometry, raster_shp['std'])]
+            rasterized_std = rasterize(
+                shapes_std,
+                out_shape=GAEZ_sample_xr.shape,
+                transform=GAEZ_sample_xr.rio.transform(),
+                fill=np.nan,
+                dtype='float32'
             )
-        ] = rasterized_std
+
+            # Assign to the DataArray
+            rasterized_multipliers.loc[
+                dict(
+                    crop=crop,
+                    year=year,
+                    band='mean'
+                )
+            ] = rasterized_mean
+
+            rasterized_multipliers.loc[
+                dict(
+                    crop=crop,
+                    year=year,
+                    band='std'
+                )
+            ] = rasterized_std
 
 # Save the rasterized multipliers to a NetCDF file
-rasterized_multipliers.to_netcdf('data/Yearbook/crop_yield_multipliers.nc')
+report.add_array('rasterized_multipliers', rasterized_multipliers)
+with report.unit('save'):
+    save_netcdf(rasterized_multipliers, 'data/Yearbook/crop_yield_multipliers.nc')
+
+report.save()
 
 
 # Plot for sanity check
@@ -6,22 +6,28 @@ import numpy as np
 
 from rasterio.features import rasterize
 from tools.constants import Province_names_cn_en
+from tools.catalog import get_sample_tif_path, load_catalog, lookup_catalog
+from tools.helpers import save_netcdf
+from tools.profiling import RunReport
+
+
+report = RunReport('step_04_actual_production_agree_yearbook')
 
 
 # --------------------------- Load GAEZ-5 data ---------------------------
-GAEZ_df = pd.read_csv('data/GAEZ_v4/GAEZ_df.csv')\
-    .query('gaez_cat == "GAEZ_5"')\
-    .query('water_supply == "Total"')\
+GAEZ_catalog = load_catalog()
+GAEZ_df = lookup_catalog(GAEZ_catalog, gaez_cat='GAEZ_5', water_supply='Total')\
     .set_index(["year", "crop", 'variable'])[['fpath']]
 
 
 GAEZ_5_arrs = []
 for idx, row in GAEZ_df.iterrows():
     year, crop, variable = idx
-    xr_data = rxr.open_rasterio(row['fpath'] + '_clipped.tif', masked=True).sel(band=1, drop=True)
-    GAEZ_5_arrs.append(
-        xr_data.expand_dims({'crop':[crop], 'variable':[variable]})
-    )
+    with report.unit('file', fpath=row['fpath']):
+        xr_data = rxr.open_rasterio(row['fpath'] + '_clipped.tif', masked=True).sel(band=1, drop=True).load()
+        GAEZ_5_arrs.append(
+            xr_data.expand_dims({'crop':[crop], 'variable':[variable]})
+        )
     
 GAEZ_5_xr = xr.combine_by_coords(GAEZ_5_arrs, combine_attrs='drop')
 Province_name2idx = {v:k for k,v in enumerate(Province_names_cn_en.values())}
@@ -70,7 +76,7 @@ yield_increase_2010_2020 = yield_increase_2010_2020.where(
 yield_increase_2010_2020_df = yield_increase_2010_2020.to_dataframe('val').reset_index()
 
 # Convert ratio to raster by crop
-GAEZ_sample_xr = rxr.open_rasterio('data/GAEZ_v4/GAEZ_tifs/0a1a4943-3ec5-490e-8670-cc3ee7953729.tif_clipped.tif', masked=True).drop_vars('band').squeeze()
+GAEZ_sample_xr = rxr.open_rasterio(get_sample_tif_path(GAEZ_catalog), masked=True).drop_vars('band').squeeze()
 China_shp = gpd.read_file('data/Vector_boundary/China_boundary.shp')
 
 crops = yield_increase_2010_2020_df['crop'].unique()
@@ -95,22 +101,23 @@ yield_increase_rasterized = xr.DataArray(
 
 # Loop through each crop, rasterizing all provinces with their multiplier values
 for crop in crops:
-    subset = yield_increase_2010_2020_df[yield_increase_2010_2020_df['crop'] == crop]
-    raster_shp = China_shp.merge(
-        subset,
-        left_on='EN_Name',
-        right_on='Province',
-        how='inner'
-    )
-    shapes = [(geom, value) for geom, value in zip(raster_shp.geometry, raster_shp['val'])]
-    rasterized = rasterize(
-        shapes,
-        out_shape=GAEZ_sample_xr.shape,
-        transform=GAEZ_sample_xr.rio.transform(),
-        fill=np.nan,
-        dtype='float32'
-    )
-    yield_increase_rasterized.loc[dict(crop=crop)] = rasterized
+    with report.unit('rasterize', crop=crop):
+        subset = yield_increase_2010_2020_df[yield_increase_2010_2020_df['crop'] == crop]
+        raster_shp = China_shp.merge(
+            subset,
+            left_on='EN_Name',
+            right_on='Province',
+            how='inner'
+        )
+        shapes = [(geom, value) for geom, value in zip(raster_shp.geometry, raster_shp['val'])]
+        rasterized = rasterize(
+            shapes,
+            out_shape=GAEZ_sample_xr.shape,
+            transform=GAEZ_sample_xr.rio.transform(),
+            fill=np.nan,
+            dtype='float32'
+        )
+        yield_increase_rasterized.loc[dict(crop=crop)] = rasterized
 
 
 
@@ -118,4 +125,7 @@ for crop in crops:
 GAEZ_yield_2010 = GAEZ_5_xr.sel(variable='Yield', drop=True)
 GAEZ_yield_2020 = GAEZ_yield_2010 * yield_increase_rasterized
 
-GAEZ_yield_2020.to_netcdf('data/GAEZ_v4/GAEZ_5_yield_2020.nc')
+with report.unit('save'):
+    save_netcdf(GAEZ_yield_2020, 'data/GAEZ_v4/GAEZ_5_yield_2020.nc')
+
+report.save()
@@ -1,88 +1,92 @@
 import itertools
 import xarray as xr
 import numpy as np
+import geopandas as gpd
 
-from scipy import stats
+from tools.constants import COMPACT_ENCODING, EXPLOITABLE_FACTOR, PERCENTILES, SAMPLE_SIZE
+from tools.helpers import apply_attainable_cap, rasterize_labels, save_netcdf, select_scenarios, set_compact_encoding, zonal_stats
+from tools.profiling import RunReport
 
 
-years = range(2020, 2101, 5)
-
-# Load yield predictions
-yield_preds_xr = xr.open_dataarray('data/crop_yield_2020_2100_by_5yr.nc')
-
-# Load exploitable yield data
-'''
-Exploitable yield is defined as 80% of attainable yield. Source:https://www.yieldgap.org/web/guest/glossary
-'''
-GAEZ_4_future_t_ha = xr.open_dataarray('data/GAEZ_v4/GAEZ_4_future_t_ha.nc')\
-    .interp(year=years, kwargs={'fill_value': 'extrapolate'}).astype(np.float32)\
-    * 0.8 
-    
-
-
-# Concat pred with attainable
-yield_pred_attainable = xr.concat([
-    yield_preds_xr.expand_dims(_type=['attainable']),
-    GAEZ_4_future_t_ha.expand_dims(_type=['attainable'])
-], dim='_type')
+report = RunReport('step_06_apply_attainable_cap')
 
 
-yield_practical_mean = yield_pred_attainable\
-    .sel(band=['mean'])\
-    .min(dim='_type')
+years = range(2020, 2101, 5)
 
-yield_practical_se = (
-    yield_preds_xr.sel(band='std', drop=True) 
-    / np.sqrt(30)
-).expand_dims(band=['se'])
-    
-yield_practical = xr.concat([
-    yield_practical_mean,
-    yield_practical_se
-], dim='band')
+# Load yield predictions, only export the selected scenarios
+yield_preds_xr = select_scenarios(xr.open_dataarray('data/crop_yield_2020_2100_by_5yr.nc'))
 
+# Load attainable yield data
+GAEZ_4_future_t_ha = select_scenarios(xr.open_dataarray('data/GAEZ_v4/GAEZ_4_future_t_ha.nc'))\
+    .sel(band=['mean', 'std'])\
+    .interp(year=years, kwargs={'fill_value': 'extrapolate'}).astype(np.float32)
 
-# Save the prediction with percentiles (25/75)
-z_25 = stats.norm.ppf(0.25)  # -0.6745
-z_75 = stats.norm.ppf(0.75)  # +0.6745
 
-yield_practical_25 = yield_practical.sel(band='mean', drop=True) + z_25 * yield_practical.sel(band='se', drop=True)
-yield_practical_75 = yield_practical.sel(band='mean', drop=True) + z_75 * yield_practical.sel(band='se', drop=True)
+# Cap the prediction at the exploitable yield, and get its percentiles (default 25/50/75)
+'''
+Exploitable yield is defined as 80% of attainable yield. Source:https://www.yieldgap.org/web/guest/glossary
+'''
+yield_practical_percentiles = apply_attainable_cap(yield_preds_xr, GAEZ_4_future_t_ha, EXPLOITABLE_FACTOR, SAMPLE_SIZE, PERCENTILES)
+yield_practical_50 = yield_practical_percentiles.sel(percentile=50, drop=True)    # template of the province raster
+
+# Save the percentiles as one cube, which is what tools/query_yield.py serves
+report.add_array('yield_practical_percentiles', yield_practical_percentiles)
+with report.unit('save_cube'):
+    save_netcdf(yield_practical_percentiles, 'data/pred_yield_t_ha_percentiles.nc')
+
+
+# Aggregate the percentiles to provinces, the pixels are sorted by province once and reduced in blocks of layers
+China_shp = gpd.read_file('data/Vector_boundary/China_boundary.shp')
+province_labels, province_names = rasterize_labels(China_shp, yield_practical_50)
+
+layer_dims = ['crop', 'rcp', 'water_supply', 'c02_fertilization', 'year', 'percentile']
+layer_pixels = yield_practical_percentiles.transpose('y', 'x', *layer_dims)
+with report.unit('province'):
+    province_mean, _ = zonal_stats(
+        layer_pixels.values.reshape(province_labels.size, *layer_pixels.shape[2:]),    # merging y/x is a view, no copy
+        province_labels.ravel(),
+        len(province_names)
+    )
+
+yield_practical_province = xr.DataArray(
+    province_mean.astype(np.float32),
+    dims=['Province', *layer_dims],
+    coords={'Province': province_names, **{d: layer_pixels[d].values for d in layer_dims}}
+)
+yield_practical_province_df = yield_practical_province.to_dataframe('yield_t_ha').reset_index()
+yield_practical_province_df = yield_practical_province_df.astype(
+    {col: 'category' for col in ['Province', 'crop', 'rcp', 'water_supply', 'c02_fertilization']}
+)
+yield_practical_province_df.to_parquet('data/pred_yield_t_ha_province.parquet', index=False)
+
+# Pack the GeoTIFFs to int16 with scale/offset, one encoding per percentile
+#   read them back with rxr.open_rasterio(path, mask_and_scale=True), masked=True alone returns the int16 codes
+yield_practical_layers = {
+    q: yield_practical_percentiles.sel(percentile=q, drop=True) for q in yield_practical_percentiles['percentile'].values
+}
+if COMPACT_ENCODING:
+    yield_practical_layers = {q: set_compact_encoding(layer) for q, layer in yield_practical_layers.items()}
 
 
 # Save as GTIFF
-crops = yield_practical['crop'].values
-years = yield_practical['year'].values
-rcps = yield_practical['rcp'].values
-water_supplies = yield_practical['water_supply'].values
-co2_fertilizations = yield_practical['c02_fertilization'].values
+crops = yield_practical_percentiles['crop'].values
+years = yield_practical_percentiles['year'].values
+rcps = yield_practical_percentiles['rcp'].values
+water_supplies = yield_practical_percentiles['water_supply'].values
+co2_fertilizations = yield_practical_percentiles['c02_fertilization'].values
 
 for crop, year, rcp, water_supply, co2_fertilization in itertools.product(crops, years, rcps, water_supplies, co2_fertilizations):
+    with report.unit('layer', crop=crop, year=year, rcp=rcp, water_supply=water_supply, c02_fertilization=co2_fertilization):
     
-    out_path = f"data/pred_yield_t_ha/{co2_fertilization}_{rcp}_{crop}_{water_supply}_{year}.tif"
-    
-    yield_practical_25.sel(
-        crop=crop,
-        year=year,
-        rcp=rcp,
-        water_supply=water_supply,
-        c02_fertilization=co2_fertilization
-    ).rio.to_raster(out_path.replace('.tif', '_25th_percentile.tif'), compress='LZW')
-    
-    
-    yield_practical.sel(    # band mean is the 50th percentile
-        band='mean',
-        crop=crop,
-        year=year,
-        rcp=rcp,
-        water_supply=water_supply,
-        c02_fertilization=co2_fertilization
-    ).rio.to_raster(out_path.replace('.tif', '_50th_percentile.tif'), compress='LZW')
+        out_path = f"data/pred_yield_t_ha/{co2_fertilization}_{rcp}_{crop}_{water_supply}_{year}.tif"
     
-    yield_practical_75.sel(
-        crop=crop,
-        year=year,
-        rcp=rcp,
-        water_supply=water_supply,
-        c02_fertilization=co2_fertilization
-    ).rio.to_raster(out_path.replace('.tif', '_75th_percentile.tif'), compress='LZW')
\ No newline at end of file
+        for q, layer in yield_practical_layers.items():
+            layer.sel(
+                crop=crop,
+                year=year,
+                rcp=rcp,
+                water_supply=water_supply,
+                c02_fertilization=co2_fertilization
+            ).rio.to_raster(out_path.replace('.tif', f'_{q}th_percentile.tif'), compress='LZW')
+
+report.save()
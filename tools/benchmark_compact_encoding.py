@@ -0,0 +1,75 @@
+import os
+import time
+import tempfile
+import numpy as np
+import xarray as xr
+
+from tools.helpers import save_netcdf
+
+
+# Benchmark the float32 vs the compact (int16 scale/offset) NetCDF encoding
+#   use the real step 05 output if it exists, otherwise a synthetic cube with the same layout
+IN_PATH = 'data/crop_yield_2020_2100_by_5yr.nc'
+N_REPEAT = 3
+
+
+def get_synthetic_yield(n_y=200, n_x=300):
+    rng = np.random.default_rng(0)
+    coords = {
+        'band': ['mean', 'std'],
+        'crop': ['Maize', 'Wetland rice', 'Wheat'],
+        'y': np.linspace(54, 18, n_y),
+        'x': np.linspace(73, 135, n_x),
+        'year': list(range(2020, 2101, 5)),
+        'rcp': ['RCP2.6', 'RCP4.5', 'RCP6.0', 'RCP8.5'],
+    }
+    shape = [len(v) for v in coords.values()]
+    data = rng.gamma(4.0, 1.5, size=shape).astype(np.float32)
+    data[:, :, :n_y // 10] = np.nan    # masked pixels outside the boundary
+    return xr.DataArray(data, dims=list(coords), coords=coords)
+
+
+def time_read(path):
+    times = []
+    for _ in range(N_REPEAT):
+        start = time.perf_counter()
+        with xr.open_dataarray(path) as arr:
+            arr.load()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if os.path.exists(IN_PATH):
+    in_xr = xr.open_dataarray(IN_PATH).load()
+else:
+    in_xr = get_synthetic_yield()
+
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    results = {}
+    for compact in [False, True]:
+        out_path = os.path.join(tmp_dir, f'compact_{compact}.nc')
+
+        start = time.perf_counter()
+        save_netcdf(in_xr, out_path, compact=compact)
+        write_time = time.perf_counter() - start
+
+        results[compact] = {
+            'size_mb': os.path.getsize(out_path) / 1024**2,
+            'write_s': write_time,
+            'read_s': time_read(out_path),
+        }
+
+    with xr.open_dataarray(os.path.join(tmp_dir, 'compact_True.nc')) as arr:
+        max_err = float(np.nanmax(np.abs(arr.values - in_xr.values)))
+        scale_factor = arr.encoding['scale_factor']
+
+
+for compact, res in results.items():
+    print(
+        f"{'int16 compact' if compact else 'float32':<14}"
+        f"size {res['size_mb']:>9.2f} MB | write {res['write_s']:>7.3f} s | read {res['read_s']:>7.3f} s"
+    )
+print(f"Size ratio: {results[True]['size_mb'] / results[False]['size_mb']:.3f}")
+print(f"Read speedup: {results[False]['read_s'] / results[True]['read_s']:.2f}x")
+print(f"Max abs error after round trip: {max_err:.6g} (scale_factor / 2 = {scale_factor / 2:.6g}, plus float32 rounding)")
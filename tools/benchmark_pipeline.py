@@ -0,0 +1,228 @@
+import os
+import sys
+import glob
+import json
+import uuid
+import argparse
+import itertools
+import subprocess
+import numpy as np
+import pandas as pd
+import xarray as xr
+import rioxarray as rxr
+import geopandas as gpd
+
+from shapely.geometry import box
+
+from tools.constants import Province_names_cn_en
+
+
+# Benchmark steps 01-06 offline on synthetic GAEZ-shaped fixtures
+#   the download is skipped, the fixtures include the catalog it would have written
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = 'data/benchmark/baseline.json'
+TOLERANCE = 0.25    # flag a regression if wall time or peak RSS grows more than 25%
+MIN_DELTA = {'wall_s': 1.0, 'peak_rss_mb': 50}    # ignore changes below timer/allocator noise
+
+STAGES = [
+    'tools/step_02_clip_GAEZ.py',
+    'step_01_merge_GAEZ_to_NC.py',
+    'step_02_get_yield_multipliers.py',
+    'step_03_get_Yearbook_multipliers.py',
+    'step_04_actual_production_agree_yearbook.py',
+    'step_05_apply_multipliers.py',
+    'step_06_apply_attainable_cap.py',
+]
+
+CROPS = {'Maize': 'maize', 'Wetland rice': 'rice', 'Wheat': 'wheat'}
+RCPS = ['RCP2.6', 'RCP4.5', 'RCP6.0', 'RCP8.5']
+WATER_SUPPLIES = ['Dryland', 'Irrigated']
+CO2_FERTILIZATIONS = ['With CO2 Fertilization', 'Without CO2 Fertilization']
+FUTURE_YEARS = ['2011-2040', '2041-2070', '2071-2100']
+
+# Extent of the synthetic global rasters, slightly larger than the province polygons so clipping has work to do
+BOUNDS = (70.0, 15.0, 138.0, 56.0)
+PROVINCE_BOUNDS = (73.0, 18.0, 135.0, 54.0)
+
+
+def write_tif(path, data, bounds=BOUNDS):
+    n_y, n_x = data.shape
+    x_min, y_min, x_max, y_max = bounds
+    res_x, res_y = (x_max - x_min) / n_x, (y_max - y_min) / n_y
+    arr = xr.DataArray(
+        data[None, ...].astype(np.float32),
+        dims=['band', 'y', 'x'],
+        coords={
+            'band': [1],
+            'y': y_max - res_y * (np.arange(n_y) + 0.5),
+            'x': x_min + res_x * (np.arange(n_x) + 0.5),
+        }
+    )
+    arr.rio.write_crs('EPSG:4326', inplace=True)
+    arr.rio.write_nodata(np.nan, inplace=True)
+    arr.rio.to_raster(path)
+
+
+def make_synthetic_fixtures(root, n_y=180, n_x=340, n_models=5, n_rcps=4, seed=0):
+    """Write a catalog, GeoTIFFs, yearbook CSVs and province polygons under root/data."""
+    rng = np.random.default_rng(seed)
+    for folder in ['GAEZ_v4/GAEZ_tifs', 'Vector_boundary', 'Yearbook', 'pred_yield_t_ha']:
+        os.makedirs(os.path.join(root, 'data', folder), exist_ok=True)
+
+    # A smooth spatial pattern of yield (kg/ha), perturbed per crop/scenario/model
+    yy, xx = np.meshgrid(np.linspace(0, 1, n_y), np.linspace(0, 1, n_x), indexing='ij')
+    base = 4000 + 3000 * np.sin(3 * xx) * np.cos(2 * yy)
+
+    rows = []
+    def add_tif(scale, **meta):    # base is kg/ha, scale 1e-3 gives t/ha
+        fpath = f"data/GAEZ_v4/GAEZ_tifs/{uuid.uuid4()}.tif"
+        write_tif(os.path.join(root, fpath), base * scale * rng.normal(1, 0.05, size=base.shape))
+        rows.append({**meta, 'fpath': fpath})
+
+    attainable = 'Average attainable yield of current cropland'
+    for crop, water_supply in itertools.product(CROPS, WATER_SUPPLIES):
+        add_tif(
+            1.0, gaez_cat='GAEZ_4', name='ycHg' if water_supply == 'Irrigated' else 'ycHa',
+            variable=attainable, year='1981-2010', model='CRUTS32', rcp='Historical', crop=crop,
+            water_supply=water_supply, input_level='High', c02_fertilization='With CO2 Fertilization'
+        )
+
+    models = [f'MODEL-{i}' for i in range(n_models)]
+    for model, rcp, crop, water_supply, co2, year in itertools.product(
+            models, RCPS[:n_rcps], CROPS, WATER_SUPPLIES, CO2_FERTILIZATIONS, FUTURE_YEARS):
+        add_tif(
+            1.0 + 0.1 * FUTURE_YEARS.index(year) * rng.uniform(0.5, 1.5), gaez_cat='GAEZ_4', name='ycXX',
+            variable=attainable, year=year, model=model, rcp=rcp, crop=crop,
+            water_supply=water_supply, input_level='High', c02_fertilization=co2
+        )
+
+    for crop, variable in itertools.product(CROPS, ['Yield', 'Harvested area']):
+        # GAEZ_5 yield is read as t/ha by step 04 (harvested area, 1000 ha per pixel, is on a similar scale)
+        add_tif(1e-3, gaez_cat='GAEZ_5', variable=variable, year=2010, crop=crop, water_supply='Total')
+
+    pd.DataFrame(rows).to_csv(os.path.join(root, 'data/GAEZ_v4/GAEZ_df.csv'), index=False)
+
+    # Province polygons on a regular grid over the extent
+    x_min, y_min, x_max, y_max = PROVINCE_BOUNDS
+    n_col = 8
+    n_row = int(np.ceil(len(Province_names_cn_en) / n_col))
+    width, height = (x_max - x_min) / n_col, (y_max - y_min) / n_row
+    geoms = [
+        box(x_min + (i % n_col) * width, y_max - (i // n_col + 1) * height,
+            x_min + (i % n_col + 1) * width, y_max - (i // n_col) * height)
+        for i in range(len(Province_names_cn_en))
+    ]
+    gpd.GeoDataFrame(
+        {'EN_Name': list(Province_names_cn_en.values())}, geometry=geoms, crs='EPSG:4326'
+    ).to_file(os.path.join(root, 'data/Vector_boundary/China_boundary.shp'))
+
+    # Yearbook yields (kg/ha) with a linear trend
+    for file_name in CROPS.values():
+        df = pd.DataFrame({
+            f'{year}年': 4000 + 60 * (year - 1990) + rng.normal(0, 150, len(Province_names_cn_en))
+            for year in range(1990, 2023)
+        })
+        df.insert(0, '地区', list(Province_names_cn_en.keys()))
+        df.to_csv(os.path.join(root, f'data/Yearbook/Provincial_{file_name}_yield.csv'), index=False)
+
+    return len(rows)
+
+
+def run_stage(root, stage):
+    """Run one stage in a fresh process under root, returns its stage and unit records."""
+    env = {**os.environ, 'PYTHONPATH': REPO_DIR, 'MPLBACKEND': 'Agg'}
+    result = subprocess.run(
+        [sys.executable, os.path.join(REPO_DIR, stage)],
+        cwd=root, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        result.check_returncode()
+    stage_name = stage.replace('/', '_').replace('.py', '')
+    report_path = sorted(glob.glob(os.path.join(root, 'data/run_reports', f'{stage_name}_*.json')))[-1]
+    with open(report_path) as f:
+        return pd.DataFrame(json.load(f))
+
+
+def get_clipped_pixels(root):
+    """Pixels of one clipped GeoTIFF, the input raster of steps 01 and 04."""
+    fpath = sorted(glob.glob(os.path.join(root, 'data/GAEZ_v4/GAEZ_tifs/*_clipped.tif')))[0]
+    return int(np.prod(rxr.open_rasterio(fpath).shape[-2:]))
+
+
+def summarize(records, n_pixels):
+    """Summarize a stage's run report, the throughput counts the GeoTIFFs the stage itself read ('file' units)."""
+    stage = records.query('kind == "stage"').iloc[0]
+    units = records.query('kind != "stage"').groupby('kind')['wall_s'].agg(['count', 'sum'])
+    n_files = int(units.loc['file', 'count']) if 'file' in units.index else 0
+    return {
+        'wall_s': stage['wall_s'],
+        'cpu_s': stage['cpu_s'],
+        'peak_rss_mb': stage['peak_rss_mb'],
+        'read_mb': stage['read_mb'],
+        'write_mb': stage['write_mb'],
+        'input_mpix_per_s': n_files * n_pixels / 1e6 / stage['wall_s'] if n_files else None,    # GeoTIFF pixels read per second
+        'units': {k: {'count': int(v['count']), 'wall_s': v['sum']} for k, v in units.iterrows()},
+    }
+
+
+def compare_to_baseline(results, baseline):
+    regressions = []
+    for stage, res in results.items():
+        if stage not in baseline:
+            continue
+        for metric in ['wall_s', 'peak_rss_mb']:
+            ratio = res[metric] / baseline[stage][metric]
+            delta = res[metric] - baseline[stage][metric]
+            flag = 'REGRESSION' if ratio > 1 + TOLERANCE and delta > MIN_DELTA[metric] else ''
+            print(f"  {stage:<45}{metric:<12}{baseline[stage][metric]:>10.2f} -> {res[metric]:>10.2f} ({ratio:.2f}x) {flag}")
+            if flag:
+                regressions.append((stage, metric))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark steps 01-06 on synthetic fixtures")
+    parser.add_argument('root', help='Directory for the synthetic fixtures and outputs')
+    parser.add_argument('--n-y', type=int, default=180)
+    parser.add_argument('--n-x', type=int, default=340)
+    parser.add_argument('--n-models', type=int, default=5)
+    parser.add_argument('--n-rcps', type=int, default=4, choices=range(1, len(RCPS) + 1))
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args()
+
+    config = f'{args.n_y}x{args.n_x}_models{args.n_models}_rcps{args.n_rcps}'
+    n_tifs = make_synthetic_fixtures(args.root, args.n_y, args.n_x, args.n_models, args.n_rcps)
+    print(f"Synthetic fixtures ({config}): {n_tifs} GeoTIFFs under {args.root}")
+
+    results = {}
+    for stage in STAGES:
+        records = run_stage(args.root, stage)
+        # The clip step reads the full fixtures, later steps the clipped ones
+        n_pixels = args.n_y * args.n_x if stage == 'tools/step_02_clip_GAEZ.py' else get_clipped_pixels(args.root)
+        results[stage] = res = summarize(records, n_pixels)
+        throughput = f"{res['input_mpix_per_s']:>8.1f} Mpix/s" if res['input_mpix_per_s'] is not None else f"{'-':>8} Mpix/s"
+        print(
+            f"{stage:<45}{res['wall_s']:>8.2f} s {res['peak_rss_mb']:>8.0f} MB peak "
+            f"{throughput}  " + ', '.join(f"{k}: {v['count']}" for k, v in res['units'].items())
+        )
+
+    baseline_path = os.path.join(REPO_DIR, BASELINE_PATH)
+    baselines = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baselines = json.load(f)
+
+    regressions = []
+    if config in baselines and not args.update_baseline:
+        print(f"Compared to the baseline in {BASELINE_PATH}:")
+        regressions = compare_to_baseline(results, baselines[config])
+    else:
+        baselines[config] = results
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, 'w') as f:
+            json.dump(baselines, f, indent=2)
+        print(f"Saved the baseline for {config} to {BASELINE_PATH}")
+
+    sys.exit(1 if regressions else 0)
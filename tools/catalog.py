@@ -0,0 +1,105 @@
+import os
+import itertools
+import pandas as pd
+
+from tools.constants import SCENARIO_SELECTION
+from tools.helpers import filter_scenarios_df
+
+
+CATALOG_CSV = 'data/GAEZ_v4/GAEZ_df.csv'
+CATALOG_PARQUET = 'data/GAEZ_v4/GAEZ_df.parquet'
+
+# Levels of the catalog index, lookups are keyed on any subset of them
+CATALOG_INDEX = ['gaez_cat', 'variable', 'crop', 'water_supply', 'rcp', 'model', 'year', 'c02_fertilization']
+CATEGORICAL_COLS = [*CATALOG_INDEX, 'name', 'sub_theme_name', 'units', 'input_level']
+
+
+def save_catalog(GAEZ_df, path=CATALOG_PARQUET):
+    """Save the catalog as a typed Parquet table, the descriptive columns become categoricals."""
+    df = GAEZ_df.copy()
+    df['year'] = df['year'].astype(str)
+    for col in CATEGORICAL_COLS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    df.to_parquet(path, index=False)
+
+
+def load_catalog(path=CATALOG_PARQUET, csv_path=CATALOG_CSV, selection=SCENARIO_SELECTION):
+    """Load the catalog within the scenario selection, indexed and sorted on CATALOG_INDEX.
+
+    The Parquet table is (re)built from the CSV written by the download step if it is missing or older.
+    """
+    if not os.path.exists(path) or (
+        os.path.exists(csv_path) and os.path.getmtime(path) < os.path.getmtime(csv_path)
+    ):
+        save_catalog(pd.read_csv(csv_path), path)
+
+    catalog = filter_scenarios_df(pd.read_parquet(path), selection).set_index(CATALOG_INDEX).sort_index()
+    catalog.index = catalog.index.remove_unused_levels()    # levels hold only the values present, see lookup_catalog
+    return catalog
+
+
+def lookup_catalog(catalog, **keys):
+    """Get the catalog rows matching the keys, e.g., `lookup_catalog(catalog, gaez_cat='GAEZ_5', crop='Maize')`.
+
+    A key is a single value (numpy scalars included) or a list of values, `year` may be
+    given as int (e.g., 2010) or str. A value that does not exist in its level raises a
+    KeyError, so typos are not silently dropped. The rows are found by binary search on the sorted index (a few ms).
+    Returns a flat DataFrame (index levels as plain columns), empty if the values exist
+    but not in this combination.
+    """
+    unknown = set(keys) - set(CATALOG_INDEX)
+    if unknown:
+        raise KeyError(f"Unknown catalog levels {sorted(unknown)}, expected {CATALOG_INDEX}")
+
+    for level, values in keys.items():
+        values = [values] if pd.api.types.is_scalar(values) else list(values)
+        if level == 'year':
+            values = [str(v) for v in values]
+        absent = [v for v in values if v not in catalog.index.levels[CATALOG_INDEX.index(level)]]
+        if absent:
+            raise KeyError(f"{absent} not in the catalog level '{level}'")
+        keys[level] = values
+
+    key = tuple(keys.get(level, slice(None)) for level in CATALOG_INDEX)
+    try:
+        out = catalog.loc[key, :]
+    except KeyError:
+        out = catalog.iloc[:0]
+
+    out = out.reset_index()
+    cat_cols = [col for col in CATEGORICAL_COLS if col in out.columns]
+    out[cat_cols] = out[cat_cols].astype(object)
+    return out
+
+
+def validate_catalog(catalog, check_files=False):
+    """Report the GAEZ_4 future combinations missing from the catalog (and, optionally, missing tif files).
+
+    Returns the missing combinations as a DataFrame, e.g., the MIROC-ESM-CHEM
+    Wetland rice rows for RCP4.5 in 2071-2100.
+    """
+    future = lookup_catalog(catalog, gaez_cat='GAEZ_4').query('rcp != "Historical"')
+    dims = ['model', 'rcp', 'crop', 'water_supply', 'c02_fertilization', 'year']
+
+    expected = set(itertools.product(*[future[dim].dropna().unique() for dim in dims]))
+    present = set(future[dims].itertuples(index=False, name=None))
+    missing = pd.DataFrame(sorted(expected - present), columns=dims)
+
+    print(f"GAEZ catalog: {len(catalog)} rows, {len(missing)} missing GAEZ_4 future combinations")
+    for row in missing.itertuples(index=False):
+        print(f"  missing: {dict(zip(dims, row))}")
+
+    if check_files:
+        fpaths = catalog['fpath'] + '_clipped.tif'
+        missing_files = fpaths[~fpaths.map(os.path.exists)]
+        print(f"  {len(missing_files)} clipped tif files missing")
+        for fpath in missing_files:
+            print(f"  missing file: {fpath}")
+
+    return missing
+
+
+def get_sample_tif_path(catalog):
+    """Get a clipped GAEZ_5 tif within the scenario selection, used as the raster template."""
+    return lookup_catalog(catalog, gaez_cat='GAEZ_5')['fpath'].iloc[0] + '_clipped.tif'
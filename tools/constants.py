@@ -31,3 +31,36 @@ Province_names_cn_en = {
     '宁夏':'Ningxia',
     '新疆':'Xinjiang',
 }
+
+
+# Scenarios to process through steps 01-06
+#   trim the lists to download, clip, merge, sample and export a subset only
+SCENARIO_SELECTION = {
+    'crop': ['Maize', 'Wetland rice', 'Wheat'],
+    'water_supply': ['Dryland', 'Irrigated'],
+    'c02_fertilization': ['With CO2 Fertilization', 'Without CO2 Fertilization'],
+    'rcp': ['RCP2.6', 'RCP4.5', 'RCP6.0', 'RCP8.5'],
+}
+
+
+# Memory-mapped copies of the baseline rasters, shared by steps 05/06 and their workers
+SHARED_DIR = 'data/shared'
+
+
+# Opt-in compact storage: pack NetCDF/GeoTIFF outputs as int16 with CF
+#   scale_factor/add_offset, the max error is half of the scale_factor
+COMPACT_ENCODING = False
+
+
+# Statistics across climate models of the GAEZ_4 future yield, the 'band' dim of step 01-02 outputs
+#   'mean' and 'std' are required by steps 02-06; add 'median' for the exact model median,
+#   which keeps all model rasters of a scenario in memory instead of one at a time
+ENSEMBLE_STATS = ['mean', 'std', 'min', 'max']
+
+
+# Model parameters of steps 02/05/06, the defaults of each axis in tools/sweep_parameters.py
+MULTIPLIER_CAP_PERCENTILE = 95      # step 02, GAEZ multipliers are capped at their 95th percentile of each layer ...
+MULTIPLIER_CAP_MAX = 2.0            #   ... but at most 2.0
+SAMPLE_SIZE = 30                    # step 05, Monte Carlo samples of the multipliers
+EXPLOITABLE_FACTOR = 0.8            # step 06, exploitable yield is 80% of attainable yield (https://www.yieldgap.org/web/guest/glossary)
+PERCENTILES = [25, 50, 75]          # step 06, percentiles of the predicted yield
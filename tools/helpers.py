@@ -1,9 +1,25 @@
+import os
+import re
+import json
 import time
 import uuid
+import tempfile
+import warnings
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import xarray as xr
 import requests
 from joblib import Parallel, delayed
+from scipy import stats as sp_stats
+from rasterio.features import rasterize
 from tqdm import tqdm
 
+from tools.constants import (
+    COMPACT_ENCODING, ENSEMBLE_STATS, SCENARIO_SELECTION, SHARED_DIR,
+    MULTIPLIER_CAP_PERCENTILE, MULTIPLIER_CAP_MAX, SAMPLE_SIZE, EXPLOITABLE_FACTOR, PERCENTILES
+)
+
 
 def get_with_retry(get_url, headers, max_retries=5):
     for i in range(max_retries):
@@ -58,4 +74,393 @@ def download_GAEZ_data(GAEZ_df, n_workers=32):
     GAEZ_df['fpath'] = fpaths
 
     return GAEZ_df
-    
+
+
+def filter_scenarios_df(in_df, selection=SCENARIO_SELECTION):
+    """Keep the rows of in_df that fall within the scenario selection.
+
+    Rows shared by all scenarios are always kept, i.e., the historical
+    baseline (rcp is "Historical" or missing) and water_supply == "Total".
+    """
+    if 'rcp' in in_df.columns:
+        is_hist = in_df['rcp'].isna() | (in_df['rcp'] == 'Historical')
+    else:
+        is_hist = pd.Series(True, index=in_df.index)
+
+    keep = pd.Series(True, index=in_df.index)
+    for col, values in selection.items():
+        if col not in in_df.columns:
+            continue
+        keep_col = in_df[col].isin(values) | in_df[col].isna()
+        if col == 'water_supply':
+            keep_col |= in_df[col] == 'Total'
+        if col in ['rcp', 'c02_fertilization']:
+            keep_col |= is_hist
+        keep &= keep_col
+
+    return in_df[keep]
+
+
+def select_scenarios(in_xr, selection=SCENARIO_SELECTION):
+    """Select the scenario selection along the dims that exist in in_xr.
+
+    Dims that are fully selected are left alone, so memory-mapped arrays are not copied.
+    """
+    sel_dict = {
+        dim: [v for v in values if v in in_xr[dim].values]
+        for dim, values in selection.items()
+        if dim in in_xr.dims and not set(in_xr[dim].values.tolist()) <= set(values)
+    }
+    return in_xr.sel(sel_dict) if sel_dict else in_xr
+
+
+def get_compact_encoding(in_xr, dtype='int16'):
+    """Get CF scale_factor/add_offset encoding that packs in_xr into integer dtype.
+
+    The lowest integer is reserved for _FillValue (NaN), the remaining range
+    spans [min, max] of the data, so the max error is scale_factor / 2.
+    """
+    info = np.iinfo(dtype)
+    v_min = float(in_xr.min())
+    v_max = float(in_xr.max())
+    n_steps = int(info.max) - (int(info.min) + 1)
+
+    # scale_factor/add_offset are float32 so the data is decoded back as float32
+    scale_factor = np.float32((v_max - v_min) / n_steps if v_max > v_min else 1.0)
+    add_offset = np.float32(v_min - (int(info.min) + 1) * float(scale_factor))
+
+    return {
+        'dtype': dtype,
+        'scale_factor': scale_factor,
+        'add_offset': add_offset,
+        '_FillValue': info.min,
+    }
+
+
+def check_compact_error(in_xr, encoding):
+    """Pack/unpack in_xr with the encoding and make sure the max error is within scale_factor / 2."""
+    info = np.iinfo(encoding['dtype'])
+    scale_factor = encoding['scale_factor']
+    add_offset = encoding['add_offset']
+
+    # Loop through the first dimension to avoid copying the whole array
+    arr = np.asarray(in_xr.values)
+    arr = arr.reshape(1, *arr.shape) if arr.ndim < 2 else arr
+    max_err = 0.0
+    for layer in arr:
+        valid = np.isfinite(layer)
+        packed = np.clip(np.round((layer[valid] - add_offset) / scale_factor), info.min + 1, info.max)
+        unpacked = packed.astype(encoding['dtype']).astype(np.float32) * scale_factor + add_offset
+        if valid.any():
+            max_err = max(max_err, float(np.abs(unpacked - layer[valid]).max()))
+
+    # Allow float32 rounding on top of the quantization error
+    v_abs = max(abs(float(in_xr.min())), abs(float(in_xr.max())))
+    tolerance = float(scale_factor) / 2 + 4 * np.finfo(np.float32).eps * v_abs
+    if max_err > tolerance:
+        raise ValueError(f"Compact encoding error {max_err:.6g} exceeds the bound {tolerance:.6g}")
+    return max_err
+
+
+def set_compact_encoding(in_xr, dtype='int16'):
+    """Return a shallow copy of in_xr with a verified compact encoding attached."""
+    encoding = get_compact_encoding(in_xr, dtype)
+    max_err = check_compact_error(in_xr, encoding)
+    name = f" '{in_xr.name}'" if in_xr.name else ''
+    print(f"Compact encoding{name} as {dtype}, max error {max_err:.6g}")
+
+    out_xr = in_xr.copy(deep=False)
+    out_xr.encoding = encoding
+    return out_xr
+
+
+def save_netcdf(in_xr, path, compact=COMPACT_ENCODING):
+    """Save in_xr to netcdf, optionally packed with set_compact_encoding."""
+    if compact:
+        in_xr = set_compact_encoding(in_xr)
+    in_xr.to_netcdf(path)
+
+
+def rasterize_labels(shp, template_xr, name_col='EN_Name'):
+    """Rasterize each polygon of shp to its row number (-1 outside) on the grid of template_xr."""
+    labels = rasterize(
+        [(geom, idx) for idx, geom in enumerate(shp.geometry)],
+        out_shape=template_xr.rio.shape,
+        transform=template_xr.rio.transform(),
+        fill=-1,
+        dtype='int32'
+    )
+    return labels, shp[name_col].tolist()
+
+
+def zonal_stats(pixels, labels, n_labels, percentiles=(), block_size=64):
+    """Reduce pixels (n_pixel, *layer_shape) by labels (n_pixel,), NaNs are ignored.
+
+    The pixels are sorted by label once and reduced block_size layers at a time
+    (np.add.reduceat over the rows of each label), so only one block is copied and
+    pixels can be a strided view, e.g., a transposed cube.
+    Returns the per-label mean (n_labels, *layer_shape) and, if percentiles are given,
+    the per-label percentiles (n_percentile, n_labels, *layer_shape).
+    """
+    layer_shape = pixels.shape[1:]
+    n_layer = int(np.prod(layer_shape))
+    inside = np.flatnonzero(labels >= 0)
+    order = inside[np.argsort(labels[inside], kind='stable')]
+    bounds = np.searchsorted(labels[order], np.arange(n_labels + 1))
+    filled = np.flatnonzero(np.diff(bounds) > 0)    # reduceat needs non-empty segments
+    starts = bounds[filled]
+
+    mean = np.full((n_labels, n_layer), np.nan)
+    pct = np.full((len(percentiles), n_labels, n_layer), np.nan, dtype=np.float32)
+    for start in range(0, n_layer if len(filled) else 0, block_size):
+        stop = min(start + block_size, n_layer)
+        layer_idx = np.unravel_index(np.arange(start, stop), layer_shape)
+        block = pixels[(order[:, None], *(idx[None, :] for idx in layer_idx))]    # (n_inside, n_block), sorted by label
+
+        valid = np.isfinite(block)
+        sums = np.add.reduceat(np.where(valid, block, 0), starts, axis=0, dtype=np.float64)
+        counts = np.add.reduceat(valid, starts, axis=0, dtype=np.int64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean[filled, start:stop] = sums / counts
+
+        # Percentiles need the pixels of each label together, i.e., a slice of the sorted block
+        for label in filled if len(percentiles) else []:
+            segment = np.sort(block[bounds[label]:bounds[label + 1]], axis=0)    # NaNs sort last
+            n_valid = np.isfinite(segment).sum(axis=0)
+            if not n_valid.any():
+                continue
+            # Linear interpolation between the closest ranks, same as np.nanpercentile
+            for idx, q in enumerate(percentiles):
+                rank = np.maximum(n_valid - 1, 0) * q / 100
+                lower = np.floor(rank).astype(np.int64)
+                upper = np.ceil(rank).astype(np.int64)
+                v_lower = np.take_along_axis(segment, lower[None, :], axis=0)[0]
+                v_upper = np.take_along_axis(segment, upper[None, :], axis=0)[0]
+                pct[idx, label, start:stop] = np.where(n_valid > 0, v_lower + (v_upper - v_lower) * (rank - lower), np.nan)
+
+    mean = mean.reshape(n_labels, *layer_shape)
+    if not len(percentiles):
+        return mean, None
+    return mean, pct.reshape(len(percentiles), n_labels, *layer_shape)
+
+
+def ensemble_stats(arrs, stats=ENSEMBLE_STATS):
+    """Reduce the model rasters in arrs (an iterable, e.g., a generator reading one file at a time) to stats.
+
+    Mean/std (ddof=0) are running moments (Welford) and min/max running extremes, so only
+    one raster is held besides the accumulators; 'median' (opt-in) is exact and keeps the rasters.
+    NaNs are skipped per pixel, same as xarray's mean/std over 'model'.
+    Returns a DataArray with a 'band' dim of stats on the grid of the first raster.
+    """
+    n = mean = m2 = v_min = v_max = template = None
+    kept = []
+    for arr in arrs:
+        if template is None:
+            template = arr
+            n = np.zeros(arr.shape, dtype=np.int32)
+            mean, m2 = np.zeros(arr.shape), np.zeros(arr.shape)
+            v_min, v_max = np.full(arr.shape, np.nan), np.full(arr.shape, np.nan)
+        x = arr.values
+        valid = np.isfinite(x)
+        n += valid
+        delta = np.where(valid, x - mean, 0)
+        mean += np.divide(delta, n, out=np.zeros(n.shape), where=n > 0)
+        m2 += delta * np.where(valid, x - mean, 0)
+        v_min, v_max = np.fmin(v_min, x), np.fmax(v_max, x)
+        if 'median' in stats:
+            kept.append(x)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = {
+            'mean': np.where(n > 0, mean, np.nan),
+            'std': np.sqrt(m2 / n),
+            'min': v_min,
+            'max': v_max,
+        }
+    if 'median' in stats:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)    # all-NaN pixels outside the boundary
+            out['median'] = np.nanmedian(np.stack(kept), axis=0)
+
+    return xr.DataArray(
+        np.stack([out[stat] for stat in stats]).astype(template.dtype),
+        dims=('band', *template.dims),
+        coords={**template.coords, 'band': stats}
+    )
+
+
+@contextmanager
+def _store_lock(name, shared_dir):
+    """Exclusive lock on {name}.lock across processes, released when the file is closed."""
+    with open(os.path.join(shared_dir, f'{name}.lock'), 'a+') as f:
+        try:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX)
+        except ImportError:    # Windows
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        yield
+
+
+def _is_stale(meta_path, nc_path):
+    return not os.path.exists(meta_path) or (
+        nc_path is not None and os.path.getmtime(meta_path) < os.path.getmtime(nc_path)
+    )
+
+
+def _write_shared(in_xr, name, shared_dir):
+    """Write the buffer and swap the sidecar, the caller holds _store_lock."""
+    arr = np.ascontiguousarray(in_xr.values)
+
+    # np.memmap starts the buffer at offset 0, i.e., page aligned
+    buffer_name = f'{name}.{uuid.uuid4().hex[:8]}.dat'
+    buffer = np.memmap(os.path.join(shared_dir, buffer_name), dtype=arr.dtype, mode='w+', shape=arr.shape)
+    buffer[...] = arr
+    buffer.flush()
+    del buffer
+
+    meta = {
+        'name': in_xr.name,
+        'buffer': buffer_name,
+        'dims': list(in_xr.dims),
+        'shape': list(arr.shape),
+        'dtype': arr.dtype.str,
+        'attrs': in_xr.attrs,
+        'coords': {
+            k: {'dims': list(v.dims), 'values': v.values.tolist(), 'attrs': v.attrs}
+            for k, v in in_xr.coords.items()
+        },
+    }
+
+    # Write the sidecar last (atomic rename), it switches readers to the complete new buffer
+    fd, tmp_path = tempfile.mkstemp(prefix=f'{name}.', suffix='.json.tmp', dir=shared_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(meta, f, default=lambda o: o.item() if hasattr(o, 'item') else str(o))
+    os.replace(tmp_path, os.path.join(shared_dir, f'{name}.json'))
+
+    # Remove the buffers the sidecar no longer references (the previous one, or left by an
+    #   interrupted write), existing mappings of them stay valid after the unlink
+    pattern = re.compile(rf'{re.escape(name)}\.[0-9a-f]{{8}}\.dat')
+    for fname in os.listdir(shared_dir):
+        if pattern.fullmatch(fname) and fname != buffer_name:
+            os.remove(os.path.join(shared_dir, fname))
+
+
+def save_shared(in_xr, name, shared_dir=SHARED_DIR):
+    """Write in_xr as a raw C-order buffer ({name}.{token}.dat) with a JSON metadata sidecar ({name}.json).
+
+    Every write goes to a new buffer file, so processes attached to the previous
+    buffer keep seeing its data until they detach (the old file is only unlinked).
+    Writers and readers of the same name are serialized by a lock file ({name}.lock).
+    """
+    os.makedirs(shared_dir, exist_ok=True)
+    with _store_lock(name, shared_dir):
+        _write_shared(in_xr, name, shared_dir)
+
+
+def open_shared(name, nc_path=None, shared_dir=SHARED_DIR):
+    """Attach to a shared array zero-copy through np.memmap.
+
+    If nc_path is given and the shared copy is missing or older than it,
+    the netcdf is loaded once and written to the shared store first. Concurrent
+    workers wait on the lock, so only the first one writes and the others attach to its copy.
+    """
+    os.makedirs(shared_dir, exist_ok=True)
+    meta_path = os.path.join(shared_dir, f'{name}.json')
+    with _store_lock(name, shared_dir):
+        if _is_stale(meta_path, nc_path):
+            if nc_path is None:
+                raise FileNotFoundError(f"No shared array '{name}' in {shared_dir}")
+            _write_shared(xr.open_dataarray(nc_path).load(), name, shared_dir)
+
+        # Map the buffer while holding the lock, a writer can only unlink it afterwards
+        with open(meta_path) as f:
+            meta = json.load(f)
+        buffer = np.memmap(
+            os.path.join(shared_dir, meta.get('buffer', f'{name}.dat')),
+            dtype=np.dtype(meta['dtype']),
+            mode='r',
+            shape=tuple(meta['shape'])
+        )
+
+    return xr.DataArray(
+        buffer,
+        dims=meta['dims'],
+        coords={k: (v['dims'], np.array(v['values']), v['attrs']) for k, v in meta['coords'].items()},
+        attrs=meta['attrs'],
+        name=meta['name']
+    )
+
+
+def get_yield_multipliers(hist_t_ha, future_t_ha):
+    """Ratio of the GAEZ_4 future yield to its 2020 value, interpolated between the historical and future periods."""
+    yr_2020_t_ha = xr.concat([hist_t_ha, future_t_ha], dim='year').interp(year=[2020], method='linear')
+    yr_2020_t_ha = yr_2020_t_ha.drop_vars('year').squeeze().astype(np.float32)
+    return future_t_ha / yr_2020_t_ha
+
+
+def cap_multipliers(multipliers, percentile=MULTIPLIER_CAP_PERCENTILE, max_cap=MULTIPLIER_CAP_MAX):
+    """Clip each scenario layer of multipliers at min(percentile, max_cap).
+
+    The mean/std bands share the percentile of both bands, any other ensemble band
+    (min/max/median) is capped at its own percentile so it keeps its spread.
+    All layers are capped in one vectorized pass, returns the capped multipliers and the caps (per band).
+    """
+    caps = multipliers.sel(band=['mean', 'std'])\
+        .quantile(percentile / 100, dim=['band', 'y', 'x'], skipna=True)\
+        .drop_vars('quantile')\
+        .expand_dims(band=['mean', 'std'])
+    other_bands = [band for band in multipliers['band'].values if band not in ['mean', 'std']]
+    if other_bands:
+        other_caps = multipliers.sel(band=other_bands)\
+            .quantile(percentile / 100, dim=['y', 'x'], skipna=True)\
+            .drop_vars('quantile')
+        caps = xr.concat([caps, other_caps], dim='band').sel(band=multipliers['band'].values)
+    caps = caps.clip(max=max_cap).astype(multipliers.dtype)
+    return multipliers.clip(max=caps), caps
+
+
+def draw_standard_normal(template, sample_size, rng=np.random):
+    """Standard normal draws (float32) on the dims of template plus a 'sample' dim.
+
+    Drawing once and scaling by mean/std lets several configurations reuse the same
+    draws (common random numbers), smaller sample sizes use the first samples.
+    """
+    return xr.DataArray(
+        rng.standard_normal((*template.shape, sample_size)).astype(np.float32),
+        dims=(*template.dims, 'sample'),
+        coords={**template.coords, 'sample': np.arange(sample_size)}
+    )
+
+
+def sample_yield_prediction(yield_2020, multipliers_GAEZ, multipliers_yearbook, z_GAEZ, z_yearbook):
+    """Sample the yield prediction from the mean/std bands of both multipliers and their standard normal draws."""
+    GAEZ_mean = multipliers_GAEZ.sel(band='mean', drop=True).astype(np.float32)
+    GAEZ_std = multipliers_GAEZ.sel(band='std', drop=True).astype(np.float32)
+    GAEZ_std = GAEZ_std.where(GAEZ_std > 0, 1e-6) + 1e-6    # avoid zero std
+    yearbook_mean = multipliers_yearbook.sel(band='mean', drop=True).astype(np.float32)
+    yearbook_std = multipliers_yearbook.sel(band='std', drop=True).astype(np.float32)
+    yearbook_std = yearbook_std.where(yearbook_std > 0, 1e-6)    # avoid zero std
+
+    return yield_2020 * (GAEZ_mean + GAEZ_std * z_GAEZ) * (yearbook_mean + yearbook_std * z_yearbook)
+
+
+def apply_attainable_cap(yield_preds, attainable_t_ha, exploitable_factor=EXPLOITABLE_FACTOR,
+                         sample_size=SAMPLE_SIZE, percentiles=PERCENTILES):
+    """Cap the predicted mean yield at the exploitable yield, returns the percentiles of the capped yield.
+
+    The percentiles assume a normal distribution around the capped mean with the
+    standard error (std / sqrt(sample_size)) of the prediction.
+    """
+    yield_mean = xr.concat([
+        yield_preds.sel(band='mean', drop=True),
+        attainable_t_ha.sel(band='mean', drop=True) * exploitable_factor
+    ], dim='_type').min(dim='_type')
+    yield_se = yield_preds.sel(band='std', drop=True) / np.sqrt(sample_size)
+
+    return xr.concat(
+        # the capped mean is the 50th percentile
+        [yield_mean if q == 50 else yield_mean + sp_stats.norm.ppf(q / 100) * yield_se for q in percentiles],
+        dim=xr.DataArray(percentiles, dims='percentile', name='percentile')
+    )
@@ -0,0 +1,223 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import threading
+import psutil
+import pandas as pd
+
+from contextlib import contextmanager
+
+
+REPORT_DIR = 'data/run_reports'
+
+# Optional profiler for the whole stage, 'cprofile' or 'pyinstrument' (sampling, if installed)
+PROFILER = os.environ.get('PIPELINE_PROFILER')
+
+
+def get_io_bytes():
+    """Bytes read/written by this process so far (Linux only, zeros elsewhere)."""
+    io = {'rchar': 0, 'wchar': 0}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, val = line.split(':')
+                if key in io:
+                    io[key] = int(val)
+    except OSError:
+        pass
+    return io['rchar'], io['wchar']
+
+
+def get_rss_mb():
+    """Current resident memory of this process."""
+    return psutil.Process().memory_info().rss / 1024**2
+
+
+def get_peak_rss_mb():
+    """Peak resident memory over the lifetime of this process (current RSS where the OS has no peak)."""
+    try:
+        import resource    # POSIX only, ru_maxrss is KB on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        mem = psutil.Process().memory_info()
+        return getattr(mem, 'peak_wset', mem.rss) / 1024**2    # peak working set on Windows
+
+
+class _RSSSampler(threading.Thread):
+    """Daemon thread sampling the RSS where the kernel peak can't be reset, misses spikes shorter than interval."""
+
+    def __init__(self, interval=0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self.peak_mb = get_rss_mb()
+        self.start()
+
+    def run(self):
+        while True:
+            rss = get_rss_mb()
+            with self._lock:
+                self.peak_mb = max(self.peak_mb, rss)
+            time.sleep(self.interval)
+
+    def reset(self):
+        with self._lock:
+            self.peak_mb = get_rss_mb()
+
+
+_rss_sampler = None
+
+
+def reset_peak_rss():
+    """Restart the peak of get_peak_rss_since_reset_mb from the current RSS (process-wide).
+
+    On Linux this resets the kernel high-water mark (VmHWM, and with it ru_maxrss),
+    elsewhere it starts a sampling thread on the first call.
+    """
+    global _rss_sampler
+    if _rss_sampler is None:
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            return
+        except OSError:
+            _rss_sampler = _RSSSampler()
+    _rss_sampler.reset()
+
+
+def get_peak_rss_since_reset_mb():
+    """Peak resident memory since the last reset_peak_rss (the lifetime peak if never reset)."""
+    if _rss_sampler is not None:
+        return max(_rss_sampler.peak_mb, get_rss_mb())
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return get_peak_rss_mb()
+
+
+def get_cpu_s():
+    """CPU time of this process and its finished child processes (e.g., joblib workers, POSIX only)."""
+    cpu = psutil.Process().cpu_times()
+    return cpu.user + cpu.system + getattr(cpu, 'children_user', 0) + getattr(cpu, 'children_system', 0)
+
+
+class RunReport:
+    """Record wall time, CPU time, memory, bytes read/written and array sizes of a stage.
+
+    The stage itself is one record, inner units (per file, per year, per
+    scenario layer) are recorded with `unit`. `save` writes all records
+    to a JSON and a CSV run report in REPORT_DIR. Every record has the
+    peak RSS within it (`peak_rss_mb`, the high-water mark is reset when a
+    unit starts) and the RSS change over it (`rss_delta_mb`, memory kept).
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.records = []
+        self._arrays = [[]]
+        self._peaks = [get_peak_rss_since_reset_mb()]    # of the stage and each open unit
+        self._start = self._snapshot()
+
+        self._profiler = None
+        if PROFILER == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif PROFILER == 'pyinstrument':
+            from pyinstrument import Profiler
+            self._profiler = Profiler()
+            self._profiler.start()
+
+    @staticmethod
+    def _snapshot():
+        read_bytes, write_bytes = get_io_bytes()
+        return {
+            'wall': time.perf_counter(),
+            'cpu': get_cpu_s(),
+            'read_bytes': read_bytes,
+            'write_bytes': write_bytes,
+            'rss_mb': get_rss_mb(),
+        }
+
+    def _diff(self, start):
+        end = self._snapshot()
+        return {
+            'wall_s': end['wall'] - start['wall'],
+            'cpu_s': end['cpu'] - start['cpu'],
+            'rss_delta_mb': end['rss_mb'] - start['rss_mb'],
+            'read_mb': (end['read_bytes'] - start['read_bytes']) / 1024**2,
+            'write_mb': (end['write_bytes'] - start['write_bytes']) / 1024**2,
+        }
+
+    @contextmanager
+    def unit(self, kind, **tags):
+        """Record one inner unit, e.g., `with report.unit('year', year=2050):`."""
+        self._update_peaks()
+        reset_peak_rss()
+        self._peaks.append(0)
+        start = self._snapshot()
+        self._arrays.append([])
+        try:
+            yield
+        finally:
+            self._update_peaks()
+            peak_rss_mb = self._peaks.pop()
+            arrays = self._arrays.pop()
+            self.add_record(kind, **tags, **self._diff(start), peak_rss_mb=peak_rss_mb, **self._summarize_arrays(arrays))
+
+    def _update_peaks(self):
+        """Fold the peak since the last reset into the stage and the open units, before it is reset again."""
+        peak = get_peak_rss_since_reset_mb()
+        self._peaks = [max(p, peak) for p in self._peaks]
+
+    def add_array(self, name, arr):
+        """Attach the size of an array to the current unit (or the stage)."""
+        self._arrays[-1].append({'name': name, 'shape': list(arr.shape), 'mb': arr.nbytes / 1024**2})
+
+    def add_record(self, kind, **fields):
+        """Add a record measured elsewhere, e.g., returned by a parallel worker."""
+        self.records.append({'stage': self.stage, 'kind': kind, **fields})
+
+    @staticmethod
+    def _summarize_arrays(arrays):
+        if not arrays:
+            return {}
+        return {
+            'array_mb': sum(a['mb'] for a in arrays),
+            'arrays': '; '.join(f"{a['name']}{tuple(a['shape'])}" for a in arrays),
+        }
+
+    def save(self):
+        """Record the whole stage and write the run report, returns the JSON path."""
+        self._update_peaks()
+        peak_rss_mb = max(self._peaks[0], get_peak_rss_mb())
+        self.add_record('stage', **self._diff(self._start), peak_rss_mb=peak_rss_mb, **self._summarize_arrays(self._arrays[0]))
+
+        os.makedirs(REPORT_DIR, exist_ok=True)
+        out_path = os.path.join(REPORT_DIR, f"{self.stage}_{time.strftime('%Y%m%d_%H%M%S')}")
+
+        if PROFILER == 'cprofile':
+            self._profiler.disable()
+            self._profiler.dump_stats(out_path + '.prof')
+        elif PROFILER == 'pyinstrument':
+            self._profiler.stop()
+            with open(out_path + '.html', 'w') as f:
+                f.write(self._profiler.output_html())
+
+        with open(out_path + '.json', 'w') as f:
+            json.dump(self.records, f, indent=2, default=lambda o: o.item() if hasattr(o, 'item') else str(o))
+        pd.DataFrame(self.records).to_csv(out_path + '.csv', index=False)
+
+        stage = self.records[-1]
+        print(
+            f"{self.stage}: {stage['wall_s']:.1f} s wall, {stage['cpu_s']:.1f} s CPU, "
+            f"{stage['peak_rss_mb']:.0f} MB peak RSS, read {stage['read_mb']:.0f} MB, "
+            f"wrote {stage['write_mb']:.0f} MB -> {out_path}.json"
+        )
+        return out_path + '.json'
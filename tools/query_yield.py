@@ -0,0 +1,192 @@
+import sys
+import json
+import time
+import hashlib
+import threading
+import numpy as np
+import xarray as xr
+import geopandas as gpd
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from tools.helpers import rasterize_labels, zonal_stats
+
+
+CUBE_PATH = 'data/pred_yield_t_ha_percentiles.nc'
+SPATIAL_DIMS = ['y', 'x']
+LABEL_CACHE_SIZE = 16    # label rasters kept for repeated zonal queries, least recently used dropped first
+
+
+class YieldQuery:
+    """Batched point lookups and zonal statistics over the step 06 percentile cube.
+
+    The cube is held as a (pixel, layer) matrix, where a layer is one
+    (percentile, crop, year, rcp, water_supply, c02_fertilization) combination.
+    A point lookup is a single fancy-index take on that matrix, and zonal
+    statistics are a bincount/segment reduction over a label raster. On a
+    typical machine a 10k-point batch across all layers takes well under 1 s.
+    """
+
+    def __init__(self, path=CUBE_PATH):
+        cube = xr.open_dataarray(path).load()
+        self.template = cube.isel({d: 0 for d in cube.dims if d not in SPATIAL_DIMS}, drop=True)
+
+        # Pixel-major matrix, so all layers of a pixel are contiguous
+        layer_dims = [d for d in cube.dims if d not in SPATIAL_DIMS]
+        cube = cube.transpose(*SPATIAL_DIMS, *layer_dims)
+        self.n_y, self.n_x = cube.shape[:2]
+        self.pixels = cube.values.reshape(self.n_y * self.n_x, -1)
+
+        # Index of each layer in the matrix, labeled with the layer dims for selection
+        self.layers = xr.DataArray(
+            np.arange(self.pixels.shape[1]).reshape(cube.shape[2:]),
+            dims=layer_dims,
+            coords={d: cube[d].values for d in layer_dims}
+        )
+
+        # Spatial index: the grid is regular, so the pixel of a coordinate is the inverse affine transform
+        self.transform = self.template.rio.transform()
+
+        # Cache of label rasters, keyed by the content of the polygons (ids are reused after garbage collection)
+        self._labels = OrderedDict()
+        self._labels_lock = threading.Lock()
+
+    def _select_layers(self, sel_dict):
+        sel_dict = {k: v for k, v in sel_dict.items() if v is not None}
+        return self.layers.sel(sel_dict)
+
+    def _wrap(self, values, dim, coords, layers):
+        return xr.DataArray(
+            values.reshape(values.shape[0], *layers.shape),
+            dims=[dim, *layers.dims],
+            coords={**coords, **layers.coords},
+            name='yield_t_ha'
+        )
+
+    def points(self, lon, lat, **sel_dict):
+        """Yield at each (lon, lat) for the selected layers, NaN outside the grid."""
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+        cols = np.floor((lon - self.transform.c) / self.transform.a).astype(np.int64)
+        rows = np.floor((lat - self.transform.f) / self.transform.e).astype(np.int64)
+        inside = (cols >= 0) & (cols < self.n_x) & (rows >= 0) & (rows < self.n_y)
+
+        layers = self._select_layers(sel_dict)
+        flat_idx = np.where(inside, rows * self.n_x + cols, 0)
+        values = self.pixels[flat_idx[:, None], layers.values.ravel()[None, :]]
+        values[~inside] = np.nan
+
+        return self._wrap(values, 'point', {'lon': ('point', lon), 'lat': ('point', lat)}, layers)
+
+    def zonal(self, shp, name_col='EN_Name', percentiles=(), **sel_dict):
+        """Mean (and percentiles) of the pixels within each polygon of shp for the selected layers."""
+        key = hashlib.sha1(
+            b''.join(shp.geometry.to_wkb()) + json.dumps(shp[name_col].astype(str).tolist()).encode()
+        ).hexdigest()
+        with self._labels_lock:
+            cached = self._labels.get(key)
+            if cached is not None:
+                self._labels.move_to_end(key)
+        if cached is None:
+            labels, names = rasterize_labels(shp, self.template, name_col)
+            cached = (labels.ravel(), names)
+            with self._labels_lock:
+                self._labels[key] = cached
+                while len(self._labels) > LABEL_CACHE_SIZE:
+                    self._labels.popitem(last=False)
+        labels, names = cached
+
+        layers = self._select_layers(sel_dict)
+        pixels = self.pixels[:, layers.values.ravel()]
+        mean, pct = zonal_stats(pixels, labels, len(names), percentiles)
+
+        out = [self._wrap(mean, 'zone', {'zone': names}, layers).expand_dims(stat=['mean'])]
+        for q, values in zip(percentiles, pct if pct is not None else []):
+            out.append(self._wrap(values, 'zone', {'zone': names}, layers).expand_dims(stat=[f'p{q}']))
+        return xr.concat(out, dim='stat')
+
+
+def to_records(out_xr):
+    return out_xr.to_dataframe().reset_index().replace({np.nan: None}).to_dict('records')
+
+
+def parse_sel(params):
+    """Convert query parameters to a selection, e.g., year=2050,2060 -> {'year': [2050, 2060]}."""
+    sel_dict = {}
+    for k, v in params.items():
+        values = [int(i) if i.lstrip('-').isdigit() else i for i in ','.join(v).split(',')]
+        sel_dict[k] = values
+    return sel_dict
+
+
+def serve(query, host='127.0.0.1', port=8000):
+    """Serve the query over local HTTP.
+
+    GET  /points?lon=116.4,121.5&lat=39.9,31.2&crop=Maize&year=2050
+    POST /zonal?crop=Maize&percentiles=25,75   (body: GeoJSON FeatureCollection with an EN_Name property)
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send(self, status, body):
+            body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            if url.path != '/points':
+                return self._send(404, {'error': f'Unknown path {url.path}'})
+            try:
+                lon = [float(i) for i in params.pop('lon')[0].split(',')]
+                lat = [float(i) for i in params.pop('lat')[0].split(',')]
+                self._send(200, to_records(query.points(lon, lat, **parse_sel(params))))
+            except (KeyError, ValueError) as e:
+                self._send(400, {'error': str(e)})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            if url.path != '/zonal':
+                return self._send(404, {'error': f'Unknown path {url.path}'})
+            try:
+                geojson = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                shp = gpd.GeoDataFrame.from_features(geojson['features'], crs='EPSG:4326')
+                name_col = params.pop('name_col', ['EN_Name'])[0]
+                percentiles = parse_sel({'p': params.pop('percentiles', [])}).get('p', [])
+                self._send(200, to_records(query.zonal(shp, name_col, percentiles, **parse_sel(params))))
+            except (KeyError, ValueError) as e:
+                self._send(400, {'error': str(e)})
+
+    print(f"Serving yield queries on http://{host}:{port}")
+    ThreadingHTTPServer((host, port), Handler).serve_forever()
+
+
+if __name__ == '__main__':
+
+    query = YieldQuery()
+
+    # Latency check: 10k random points across all layers
+    x_min, y_min, x_max, y_max = query.template.rio.bounds()
+    rng = np.random.default_rng(0)
+    lon = rng.uniform(x_min, x_max, 10_000)
+    lat = rng.uniform(y_min, y_max, 10_000)
+
+    start = time.perf_counter()
+    pts = query.points(lon, lat)
+    print(f"10k points x {pts[0].size} layers: {time.perf_counter() - start:.3f} s")
+
+    China_shp = gpd.read_file('data/Vector_boundary/China_boundary.shp')
+    query.zonal(China_shp)  # rasterize the provinces once
+    start = time.perf_counter()
+    zones = query.zonal(China_shp, percentiles=[25, 75])
+    print(f"Province mean/p25/p75 x {zones.isel(stat=0, zone=0).size} layers: {time.perf_counter() - start:.3f} s")
+
+    if '--serve' in sys.argv:
+        serve(query)
@@ -1,13 +1,12 @@
 import pandas as pd
-from tools.helpers import download_GAEZ_data
+from tools.constants import SCENARIO_SELECTION
+from tools.catalog import CATALOG_CSV, save_catalog, load_catalog, validate_catalog
+from tools.helpers import download_GAEZ_data, filter_scenarios_df
+from tools.profiling import RunReport
 
 
-UNIQUE_VALUES = { 
-    'crop':['Maize', 'Wetland rice', 'Wheat'],
-    'water_supply':['Dryland', 'Irrigated'],
-    'c02_fertilization':['With CO2 Fertilization', 'Without CO2 Fertilization'],
-    'rcp':['RCP2.6', 'RCP4.5', 'RCP6.0', 'RCP8.5'],
-}
+report = RunReport('tools_step_01_download_GAEZ')
+
 
 # Define the columns used in the analysis
 GAEZ_columns = {
@@ -41,9 +40,9 @@ GAEZ_water_supply = {
 }
 
 
-GAEZ_filter_con = {
-    "GAEZ_4": 'variable == "Average attainable yield of current cropland"',
-    "GAEZ_5": '(variable == "Yield" or variable == "Harvested area")' 
+GAEZ_variables = {
+    "GAEZ_4": ["Average attainable yield of current cropland"],
+    "GAEZ_5": ["Yield", "Harvested area"]
 }
 
 
@@ -54,9 +53,15 @@ for gaez_cat in ['GAEZ_4', 'GAEZ_5']:
     df = pd.read_csv(f'data/GAEZ_v4/GAEZ_raw_urls/{gaez_cat}.csv').rename(columns = {'Name':'name'})
     df = df[GAEZ_columns[gaez_cat]]
     
-    filter_con = f"crop in {UNIQUE_VALUES['crop']} and year in {GAEZ_years[gaez_cat]} and {GAEZ_filter_con[gaez_cat]}"
-    df = df.query(filter_con)
+    df = df[
+        df['crop'].isin(SCENARIO_SELECTION['crop'])
+        & df['year'].isin(GAEZ_years[gaez_cat])
+        & df['variable'].isin(GAEZ_variables[gaez_cat])
+    ]
     df['water_supply'] = df['water_supply'].replace(GAEZ_water_supply[gaez_cat])
+    
+    # Only download the selected scenarios, the historical baseline is always kept
+    df = filter_scenarios_df(df)
     df.insert(0, 'gaez_cat', gaez_cat)
 
     GAEZ_df.append(df)
@@ -65,5 +70,12 @@ for gaez_cat in ['GAEZ_4', 'GAEZ_5']:
 GAEZ_df = pd.concat(GAEZ_df).reset_index(drop = True)
 
 # Download the gaez_cat data
-GAEZ_df = download_GAEZ_data(GAEZ_df)
-GAEZ_df.to_csv('data/GAEZ_v4/GAEZ_df.csv', index = False)
\ No newline at end of file
+with report.unit('download', n_files=len(GAEZ_df)):
+    GAEZ_df = download_GAEZ_data(GAEZ_df)
+GAEZ_df.to_csv(CATALOG_CSV, index = False)
+
+# Save the typed, indexed catalog used by the later steps, and report any missing scenario combinations
+save_catalog(GAEZ_df)
+validate_catalog(load_catalog())
+
+report.save()
@@ -1,21 +1,41 @@
+import os
+import time
 import geopandas as gpd
-import pandas as pd
 import rioxarray as rxr
 
 from joblib import Parallel, delayed
 from tqdm.auto import tqdm
 
+from tools.catalog import load_catalog, validate_catalog
+from tools.profiling import RunReport, get_peak_rss_since_reset_mb, get_rss_mb, reset_peak_rss
+
+
+report = RunReport('tools_step_02_clip_GAEZ')
+
 # Read tif paths
-GAEZ_df = pd.read_csv('data/GAEZ_v4/GAEZ_df.csv')
+GAEZ_catalog = load_catalog()
+validate_catalog(GAEZ_catalog)
+GAEZ_df = GAEZ_catalog.reset_index()
 China_shp = gpd.read_file('data/Vector_boundary/China_boundary.shp')
 
 
 def clip_raster(input_path, output_path, geometry):
-    """Clip a single raster file to the given geometry and save."""
+    """Clip a single raster file to the given geometry and save, returns the timing record."""
+    reset_peak_rss()    # of the worker process, which runs one task at a time
+    start_wall, start_cpu, start_rss = time.perf_counter(), time.process_time(), get_rss_mb()
     img = rxr.open_rasterio(input_path, masked=True).drop_vars('band').squeeze()
     clipped = img.rio.clip(geometry)
     clipped.rio.to_raster(output_path)
-    return output_path
+    return {
+        'fpath': output_path,
+        'wall_s': time.perf_counter() - start_wall,
+        'cpu_s': time.process_time() - start_cpu,
+        'peak_rss_mb': get_peak_rss_since_reset_mb(),
+        'rss_delta_mb': get_rss_mb() - start_rss,    # the rasters are still held here
+        'read_mb': os.path.getsize(input_path) / 1024**2,
+        'write_mb': os.path.getsize(output_path) / 1024**2,
+        'array_mb': img.nbytes / 1024**2,
+    }
 
 
 # Create output tasks
@@ -29,5 +49,7 @@ for idx, row in GAEZ_df.iterrows():
 
 
 # Run parallel clipping
-for _ in tqdm(Parallel(n_jobs=8, return_as='generator')(tasks), total=len(tasks)):
-    pass
\ No newline at end of file
+for record in tqdm(Parallel(n_jobs=8, return_as='generator')(tasks), total=len(tasks)):
+    report.add_record('file', **record)
+
+report.save()
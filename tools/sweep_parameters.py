@@ -0,0 +1,122 @@
+import os
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from tools.constants import (
+    MULTIPLIER_CAP_PERCENTILE, MULTIPLIER_CAP_MAX, SAMPLE_SIZE, EXPLOITABLE_FACTOR, PERCENTILES
+)
+from tools.helpers import (
+    apply_attainable_cap, cap_multipliers, draw_standard_normal, get_yield_multipliers,
+    open_shared, sample_yield_prediction, save_netcdf, select_scenarios
+)
+from tools.profiling import RunReport
+
+
+# Evaluate a grid of parameter configurations of steps 02/05/06 in one run
+#   the inputs (outputs of steps 01/03/04) are loaded once, each cap is computed once and
+#   all configurations share the same random draws, so they differ by their parameters only
+SWEEP_PATH = 'data/sweep/pred_yield_t_ha_sweep.nc'
+PARAMS = ['cap_percentile', 'cap_max', 'sample_size', 'exploitable_factor']
+YEARS = range(2020, 2101, 5)
+
+
+def get_configs(cap_percentiles, cap_maxes, sample_sizes, exploitable_factors):
+    """All combinations of the parameter values, one row per configuration."""
+    configs = pd.DataFrame(
+        list(itertools.product(cap_percentiles, cap_maxes, sample_sizes, exploitable_factors)),
+        columns=PARAMS
+    )
+    configs.index.name = 'config'
+    return configs
+
+
+def run_sweep(configs, report, seed=0):
+    """Returns the yield percentiles of all configurations, with a 'config' dim in front."""
+    with report.unit('load'):
+        GAEZ_4_hist_t_ha = select_scenarios(xr.open_dataarray('data/GAEZ_v4/GAEZ_4_historical_t_ha.nc'))\
+            .sel(band=['mean', 'std']).compute()
+        GAEZ_4_future_t_ha = select_scenarios(xr.open_dataarray('data/GAEZ_v4/GAEZ_4_future_t_ha.nc'))\
+            .sel(band=['mean', 'std']).compute()
+        multipliers_yearbook = select_scenarios(open_shared('crop_yield_multipliers', 'data/Yearbook/crop_yield_multipliers.nc'))
+        yield_2020 = select_scenarios(open_shared('GAEZ_5_yield_2020', 'data/GAEZ_v4/GAEZ_5_yield_2020.nc'))
+        report.add_array('GAEZ_4_future_t_ha', GAEZ_4_future_t_ha)
+
+    GAEZ_4_multiplier = get_yield_multipliers(GAEZ_4_hist_t_ha, GAEZ_4_future_t_ha)
+    attainable_t_ha = GAEZ_4_future_t_ha.interp(year=YEARS, kwargs={'fill_value': 'extrapolate'}).astype(np.float32)
+
+    # Step 02, once per distinct cap
+    multipliers_GAEZ = {}
+    for cap_percentile, cap_max in configs[['cap_percentile', 'cap_max']].drop_duplicates().itertuples(index=False):
+        with report.unit('cap', cap_percentile=cap_percentile, cap_max=cap_max):
+            multipliers_GAEZ[cap_percentile, cap_max] = cap_multipliers(GAEZ_4_multiplier, cap_percentile, cap_max)[0]\
+                .interp(year=YEARS, kwargs={'fill_value': 'extrapolate'}).astype(np.float32)
+
+    # Steps 05/06 per year, the largest sample size is drawn once and smaller ones use its first samples
+    rng = np.random.default_rng(seed)
+    max_sample_size = configs['sample_size'].max()
+    template_GAEZ = next(iter(multipliers_GAEZ.values())).sel(year=[YEARS[0]]).sel(band='mean', drop=True)
+    template_yearbook = multipliers_yearbook.sel(year=[YEARS[0]]).sel(band='mean', drop=True)
+
+    yield_percentiles = {idx: [] for idx in configs.index}
+    for yr in YEARS:
+        with report.unit('year', year=yr):
+            z_GAEZ = draw_standard_normal(template_GAEZ, max_sample_size, rng).assign_coords(year=[yr])
+            z_yearbook = draw_standard_normal(template_yearbook, max_sample_size, rng).assign_coords(year=[yr])
+
+            for (cap_percentile, cap_max, sample_size), group in configs.groupby(['cap_percentile', 'cap_max', 'sample_size']):
+                yield_prediction = sample_yield_prediction(
+                    yield_2020,
+                    multipliers_GAEZ[cap_percentile, cap_max].sel(year=[yr]),
+                    multipliers_yearbook.sel(year=[yr]),
+                    z_GAEZ.isel(sample=slice(sample_size)),
+                    z_yearbook.isel(sample=slice(sample_size)),
+                )
+                yield_preds = xr.concat([
+                    yield_prediction.mean(dim='sample').expand_dims(band=['mean']),
+                    yield_prediction.std(dim='sample').expand_dims(band=['std'])
+                ], dim='band')
+
+                for idx, exploitable_factor in group['exploitable_factor'].items():
+                    yield_percentiles[idx].append(
+                        apply_attainable_cap(yield_preds, attainable_t_ha.sel(year=[yr]), exploitable_factor, sample_size, PERCENTILES)
+                        .astype(np.float32)
+                    )
+
+        print(f'Processed year: {yr}')
+
+    return xr.concat(
+        [xr.concat(yield_percentiles[idx], dim='year') for idx in configs.index],
+        dim=xr.DataArray(configs.index, dims='config', name='config')
+    ).assign_coords({param: ('config', configs[param].values) for param in PARAMS})
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Sweep the parameters of steps 02/05/06, run after step 04")
+    parser.add_argument('--cap-percentile', type=float, nargs='+', default=[MULTIPLIER_CAP_PERCENTILE])
+    parser.add_argument('--cap-max', type=float, nargs='+', default=[MULTIPLIER_CAP_MAX])
+    parser.add_argument('--sample-size', type=int, nargs='+', default=[SAMPLE_SIZE])
+    parser.add_argument('--exploitable-factor', type=float, nargs='+', default=[EXPLOITABLE_FACTOR])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=SWEEP_PATH)
+    args = parser.parse_args()
+
+    report = RunReport('tools_sweep_parameters')
+    configs = get_configs(args.cap_percentile, args.cap_max, args.sample_size, args.exploitable_factor)
+    print(f"Sweeping {len(configs)} configurations")
+
+    yield_sweep = run_sweep(configs, report, args.seed)
+    report.add_array('yield_sweep', yield_sweep)
+
+    with report.unit('save'):
+        os.makedirs(os.path.dirname(args.out), exist_ok=True)
+        save_netcdf(yield_sweep, args.out)
+
+    # Mean yield of each configuration and percentile, over all pixels, scenarios and years
+    summary = yield_sweep.mean(dim=[dim for dim in yield_sweep.dims if dim not in ['config', 'percentile']])
+    print(configs.join(summary.to_pandas().add_prefix('mean_t_ha_p')).to_string())
+
+    report.save()